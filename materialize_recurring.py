@@ -0,0 +1,310 @@
+"""
+Nightly job that adds the recurring transactions of every user
+to their monthly transactions and queues the budget alerts they trigger.
+
+Run it once a day, for example with the Heroku Scheduler:
+    python3 materialize_recurring.py
+"""
+import sys
+from datetime import date
+from multiprocessing import Pool
+
+import gspread
+import requests
+from gspread.utils import rowcol_to_a1
+
+from run import (
+    ALERT_QUEUE_HEADER, ALERTS_HEADER, RECURRING_HEADER, SCOPED_CREDS,
+    alert_message, compile_alert_rules, crossed_threshold,
+    get_shared_worksheet, read_user_worksheets, with_retries)
+from sheet_cache import close_connection, invalidate
+
+# Number of users read and written with a single request
+CHUNK_SIZE = 50
+
+# Number of worker processes. They all share the per minute quota of
+# the service account, so more processes would only wait longer.
+WORKERS = 4
+
+# Spreadsheet opened by each worker process
+WORKER_SHEET = None
+
+
+def init_worker():
+    """
+    Opens a Google Sheets client for the worker process,
+    as the connection can't be shared between processes.
+    """
+
+    global WORKER_SHEET
+    WORKER_SHEET = gspread.authorize(SCOPED_CREDS).open('finance_guardian')
+
+
+def due_months(last_posted, today):
+    """
+    Returns the month numbers of this year which are due
+    after the last posted YYYY-MM month, up to today's month.
+    """
+
+    year, month = (int(num) for num in last_posted.split("-"))
+
+    if year < today.year:
+        month = 0
+    elif year > today.year:
+        return []
+
+    return list(range(month + 1, today.month + 1))
+
+
+def dropped_months(last_posted, today):
+    """
+    Returns the YYYY-MM months of a previous year which were not
+    posted. The worksheets only hold one year, so they can't be
+    posted without adding them to this year's months.
+    """
+
+    year, month = (int(num) for num in last_posted.split("-"))
+
+    if year >= today.year:
+        return []
+
+    return [f"{year}-{num:02d}" for num in range(month + 1, 13)]
+
+
+def validate_rule(row):
+    """
+    Validates the category, amount and last_posted month
+    of a recurring transaction rule.
+    """
+
+    try:
+        category = int(row[1])
+        float(row[2])
+        _, month = (int(num) for num in row[3].split("-"))
+    except ValueError:
+        return False
+
+    return 1 <= category <= 10 and 1 <= month <= 12
+
+
+def load_rules():
+    """
+    Reads all the recurring transaction rules with a single request
+    and groups them by user_id, keeping the sheet row of each rule.
+    Invalid rules are reported and skipped.
+    """
+
+    rules = {}
+    recurring_wks = get_shared_worksheet("recurring", RECURRING_HEADER)
+    rows = recurring_wks.get_all_values()[1:]
+
+    # Skip the cleared rows of removed rules
+    for row_num, row in enumerate(rows, 2):
+        if len(row) < 4 or not row[0]:
+            continue
+        if not validate_rule(row):
+            print(f"Skipped invalid rule on row {row_num}: {row[:4]}")
+            continue
+        rules.setdefault(row[0], []).append((row_num, row))
+
+    return rules
+
+
+def cell_value(values, row, col):
+    """
+    Returns the number in a cell of the values read from a worksheet,
+    where empty trailing cells are not returned by the API.
+    """
+
+    try:
+        return float(values[row - 1][col - 1] or 0)
+    except IndexError:
+        return 0.0
+
+
+def materialize_user(user_id, rules, alert_rules, values, today):
+    """
+    Returns the cells to write for the due entries of a user,
+    the alerts they trigger and the number of entries posted.
+    """
+
+    this_month = f"{today.year}-{today.month:02d}"
+    data = []
+    messages = []
+    transactions = {}
+    posted = 0
+
+    for row_num, rule in rules:
+        _, category, amount, last_posted = rule[:4]
+        months = due_months(last_posted, today)
+
+        dropped = dropped_months(last_posted, today)
+        if dropped:
+            print(
+                f"Not posted for user {user_id} on rule row {row_num}: "
+                f"{', '.join(dropped)}")
+        if not months:
+            continue
+
+        for month in months:
+            row = int(category) + 1
+            col = (month * 2) + 2
+            if (row, col) not in transactions:
+                transactions[row, col] = cell_value(values, row, col)
+            transactions[row, col] += float(amount)
+            posted += 1
+
+        data.append({
+            "range": f"recurring!D{row_num}",
+            "values": [[this_month]],
+        })
+
+    for (row, col), value in transactions.items():
+        data.append({
+            "range": f"'{user_id}'!{rowcol_to_a1(row, col)}",
+            "values": [[value]],
+        })
+
+        if row not in alert_rules:
+            continue
+        budget = cell_value(values, row, col - 1)
+        percent = crossed_threshold(
+            alert_rules[row], budget, cell_value(values, row, col), value)
+        if percent is not None:
+            messages.append([user_id, alert_message(
+                values[0][col - 2], values[row - 1][0],
+                percent, value, budget)])
+
+    return data, messages, posted
+
+
+def materialize_chunk(chunk):
+    """
+    Posts the due entries of a chunk of users. The new transaction
+    values and the last_posted month of the rules are written with a
+    single request, so a rerun after a crash never posts them twice.
+    The alerts triggered by the new values are queued before that
+    request, so a crash in between can queue an alert twice on the
+    rerun but never loses it.
+    Users whose worksheet is missing are skipped, and users whose
+    worksheet can't be read are reported as failed.
+    Returns the number of entries posted, the skipped user_ids
+    and the failed user_ids.
+    """
+
+    today = date.today()
+
+    user_ids = [user_id for user_id, _, _ in chunk]
+    chunk_values = read_user_worksheets(WORKER_SHEET, user_ids)
+
+    data = []
+    messages = []
+    skipped = []
+    failed = []
+    posted = 0
+    for (user_id, rules, alert_rules), values in zip(chunk, chunk_values):
+        if values is None:
+            skipped.append(user_id)
+            continue
+
+        # A hand edited worksheet only fails its own user
+        try:
+            user_data, user_messages, user_posted = materialize_user(
+                user_id, rules, alert_rules, values, today)
+        except (ValueError, IndexError) as e:
+            print(f"Failed to materialize user {user_id}: {e}")
+            failed.append(user_id)
+            continue
+
+        data += user_data
+        messages += user_messages
+        posted += user_posted
+
+    if messages:
+        with_retries(
+            WORKER_SHEET.values_append,
+            "alert_queue!A:B",
+            params={
+                "valueInputOption": "RAW",
+                "insertDataOption": "INSERT_ROWS",
+            },
+            body={"values": messages})
+
+    if data:
+        with_retries(WORKER_SHEET.values_batch_update, {
+            "valueInputOption": "RAW",
+            "data": data,
+        })
+
+        # This only refreshes the cache of the node running the job.
+        # Other nodes serve the old values until they expire, and
+        # sessions read the column directly before saving.
+        for user_id in user_ids:
+            invalidate(user_id)
+        invalidate("recurring")
+
+    return posted, skipped, failed
+
+
+def run_chunk(chunk):
+    """
+    Materializes a chunk of users, reporting an error instead of
+    stopping the other chunks. A chunk that fails before its batch
+    update posts nothing, so it is posted by the next run.
+    Returns the number of entries posted, the skipped user_ids
+    and the failed user_ids.
+    """
+
+    try:
+        return materialize_chunk(chunk)
+    except (gspread.exceptions.APIError,
+            requests.exceptions.RequestException) as e:
+        print(f"Failed to materialize a chunk: {e}")
+        return 0, [], [user_id for user_id, _, _ in chunk]
+
+
+def main():
+    """
+    Splits the users with recurring transactions in chunks
+    and materializes them across a process pool.
+    """
+
+    # Make sure the workers can append to the alert queue
+    get_shared_worksheet("alert_queue", ALERT_QUEUE_HEADER)
+
+    alerts_wks = get_shared_worksheet("alerts", ALERTS_HEADER)
+    alert_rules = compile_alert_rules(alerts_wks.get_all_values()[1:])
+    rules = [
+        (user_id, user_rules, alert_rules.get(user_id, {}))
+        for user_id, user_rules in load_rules().items()
+    ]
+    chunks = [
+        rules[ind:ind + CHUNK_SIZE]
+        for ind in range(0, len(rules), CHUNK_SIZE)
+    ]
+
+    print(f"Materializing recurring transactions of {len(rules)} users...")
+
+    posted = 0
+    skipped = []
+    failed = []
+    # The workers open their own connection to the cache
+    close_connection()
+    with Pool(WORKERS, initializer=init_worker) as pool:
+        for result in pool.imap_unordered(run_chunk, chunks):
+            posted += result[0]
+            skipped += result[1]
+            failed += result[2]
+
+    print(f"{posted} recurring transactions posted.")
+
+    if skipped:
+        print(f"Skipped users without a worksheet: {', '.join(skipped)}")
+
+    if failed:
+        print(f"Failed to post the transactions of {len(failed)} users.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
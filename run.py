@@ -1,3 +1,10 @@
+import json
+import os
+import random
+import time
+from bisect import bisect_right
+from datetime import date
+
 # Google sheets API
 import gspread
 from google.oauth2.service_account import Credentials
@@ -5,6 +12,8 @@ from google.oauth2.service_account import Credentials
 # Created the logo using pyfiglet
 import pyfiglet
 
+from sheet_cache import CachedWorksheet, cached_read, invalidate
+
 SCOPE = [
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive.file",
@@ -16,6 +25,34 @@ SCOPED_CREDS = CREDS.with_scopes(SCOPE)
 GSPREAD_CLIENT = gspread.authorize(SCOPED_CREDS)
 SHEET = GSPREAD_CLIENT.open('finance_guardian')
 
+# Folder where the session state of each user is parked
+SESSIONS_DIR = "sessions"
+
+# Number of times a request is sent when over the Sheets API quota.
+# The waits add up to about two minutes, longer than the one minute
+# window of the quota.
+MAX_RETRIES = 8
+MAX_RETRY_WAIT = 64
+
+# Headers of the worksheets shared by all users
+RECURRING_HEADER = ["user_id", "category", "amount", "last_posted"]
+ALERTS_HEADER = ["user_id", "category", "percent"]
+ALERT_QUEUE_HEADER = ["user_id", "message"]
+
+# Budget alert rules of the logged in users, compiled once per session
+ALERT_RULES = {}
+
+
+def open_worksheet(title):
+    """
+    Returns the worksheet with the title. Its properties and
+    column reads are served from the cache shared on this node.
+    """
+
+    properties = cached_read(
+        title, "properties", lambda: SHEET.worksheet(title)._properties)
+    return CachedWorksheet(SHEET, properties)
+
 
 def welcome_message():
     """
@@ -128,7 +165,7 @@ def create_username(username):
     users_worksheet.append_row(user_data)
 
     # create a new blank worksheet with the user_id
-    blank_worksheet = SHEET.worksheet("blank")
+    blank_worksheet = open_worksheet("blank")
     blank_worksheet.duplicate(new_sheet_name=f"{user_id}")
 
     print("User data successfully created.\n")
@@ -162,6 +199,7 @@ def new_budget(user_id):
     """
     Checks to see if the budget exists for the selected month
     and call the create_new_budget function.
+    Returns the next state of the session.
     """
 
     # Title
@@ -169,14 +207,14 @@ def new_budget(user_id):
     print("\nCreate New Budget\n")
     print(75 * "-")
 
-    user_wks = SHEET.worksheet(user_id)
+    user_wks = open_worksheet(user_id)
 
     # function to allow the user to select a month and validate
     selection = select_month()
 
     # return the selection and analyse what was inputed
     if selection == "0":
-        return
+        return "main_menu"
     col_num = (int(selection) * 2) + 1
     month_income = user_wks.col_values(col_num)[-1]
 
@@ -187,7 +225,7 @@ def new_budget(user_id):
             option = input("Would you like to create a new one? y/n\n")
 
             if option == "n":
-                return
+                return "main_menu"
             elif option == "y":
                 break
             else:
@@ -201,10 +239,9 @@ def new_budget(user_id):
         option = input("\nWould you like to create a new budget? y/n\n")
 
         if option == "n":
-            return
+            return "main_menu"
         elif option == "y":
-            new_budget(user_id)
-            break
+            return "new_budget"
         else:
             print("Invalid option! Please enter only Y or N.")
 
@@ -309,9 +346,12 @@ def display_budget_data(user_wks, data, col_num):
         print(f"{category:25} {budget:15} {expense:15} {balance}")
 
 
-def save_data(user_wks, data, col_num):
+def save_data(user_wks, data, col_num, saved_data=None):
     """
     Gives the user an option to save to the sheet.
+    If the saved data is given, only the cells the user changed are
+    written, so amounts posted meanwhile by the recurring job are kept.
+    Returns True if the data was saved.
     """
 
     option = input("\nWould you like to save? y/n \n")
@@ -319,15 +359,19 @@ def save_data(user_wks, data, col_num):
     if option == "y":
         print("\nSaving...")
 
-        # iterate through the list and update the sheet
+        # iterate through the list and update the changed cells
         for ind in range(len(data)):
+            if saved_data is not None and data[ind] == saved_data[ind]:
+                continue
             row = ind + 2
             value = data[ind]
             user_wks.update_cell(row, col_num, value)
 
         print("\nSuccessfully saved!")
-    else:
-        print("\nNot saved.")
+        return True
+
+    print("\nNot saved.")
+    return False
 
 
 def view_budget(user_id):
@@ -335,6 +379,7 @@ def view_budget(user_id):
     Gives the user an option to select a month
     and checks to see if a budget exists. If yes, it then
     displays the budget to the user.
+    Returns the next state of the session.
     """
 
     # Title
@@ -342,14 +387,14 @@ def view_budget(user_id):
     print("\nView Budget\n")
     print(75 * "-")
 
-    user_wks = SHEET.worksheet(user_id)
+    user_wks = open_worksheet(user_id)
 
     # function to allow the user to select a month and validate
     selection = select_month()
 
     # return the selection and analyse what was inputed
     if selection == "0":
-        return
+        return "main_menu"
     col_num = (int(selection) * 2) + 1
     month_income = user_wks.col_values(col_num)[-1]
 
@@ -363,8 +408,7 @@ def view_budget(user_id):
             if option == "n":
                 break
             elif option == "y":
-                new_budget(user_id)
-                break
+                return "new_budget"
             else:
                 print("Invalid option! Please enter only Y or N.")
     else:
@@ -376,10 +420,9 @@ def view_budget(user_id):
         option = input("\nWould you like to view a new budget? y/n\n")
 
         if option == "n":
-            return
+            return "main_menu"
         elif option == "y":
-            view_budget(user_id)
-            break
+            return "view_budget"
         else:
             print("Invalid option! Please enter only Y or N.")
 
@@ -387,6 +430,7 @@ def view_budget(user_id):
 def update_budget(user_id):
     """
     Gives the user an option to update an existing budget.
+    Returns the next state of the session.
     """
 
     # Title
@@ -394,14 +438,14 @@ def update_budget(user_id):
     print("\nUpdate Budget\n")
     print(75 * "-")
 
-    user_wks = SHEET.worksheet(user_id)
+    user_wks = open_worksheet(user_id)
 
     # function to allow the user to select a month and validate
     selection = select_month()
 
     # return the selection and analyse what was inputed
     if selection == "0":
-        return
+        return "main_menu"
     col_num = (int(selection) * 2) + 1
     month_income = user_wks.col_values(col_num)[-1]
 
@@ -415,33 +459,31 @@ def update_budget(user_id):
             if option == "n":
                 break
             elif option == "y":
-                new_budget(user_id)
-                break
+                return "new_budget"
             else:
                 print("Invalid option! Please enter only Y or N.")
     else:
-        data = input_new_budget(user_wks, col_num)
-        save_data(user_wks, data, col_num)
+        saved_data = user_wks.fresh_col_values(col_num)[1:]
+        data = input_new_budget(user_wks, list(saved_data), col_num)
+        save_data(user_wks, data, col_num, saved_data)
 
     # Option for the user to update a new budget
     while True:
         option = input("\nWould you like to update a new budget? y/n\n")
 
         if option == "n":
-            return
+            return "main_menu"
         elif option == "y":
-            update_budget(user_id)
-            break
+            return "update_budget"
         else:
             print("Invalid option! Please enter only Y or N.")
 
 
-def input_new_budget(user_wks, col_num):
+def input_new_budget(user_wks, data, col_num):
     """
     Allows the user to update existing data in budgets.
     """
 
-    data = user_wks.col_values(col_num)[1:]
     display_budget_data(user_wks, data, col_num)
     while True:
         selection = input(
@@ -469,6 +511,7 @@ def input_new_budget(user_wks, col_num):
 def delete_budget(user_id):
     """
     This function allows the user to delete a budget.
+    Returns the next state of the session.
     """
 
     # Title
@@ -476,14 +519,14 @@ def delete_budget(user_id):
     print("\nDelete Budget\n")
     print(75 * "-")
 
-    user_wks = SHEET.worksheet(user_id)
+    user_wks = open_worksheet(user_id)
 
     # function to allow the user to select a month and validate
     selection = select_month()
 
     # return the selection and analyse what was inputed
     if selection == "0":
-        return
+        return "main_menu"
     col_num = (int(selection) * 2) + 1
     month = user_wks.col_values(col_num)[0]
 
@@ -491,24 +534,28 @@ def delete_budget(user_id):
         option = input(f"Confirm deletion of {month}'s budget? y/n\n")
 
         if option == "n":
-            return
+            return "main_menu"
         elif option == "y":
             break
         else:
             print("Invalid option! Please enter only Y or N.")
 
     print(f"Deleting {month}'s budget...")
-    data = user_wks.col_values(col_num)[1:]
+    saved_data = user_wks.fresh_col_values(col_num)[1:]
+    data = list(saved_data)
 
     for num in range(len(data)):
         data[num] = "0"
 
-    save_data(user_wks, data, col_num)
+    save_data(user_wks, data, col_num, saved_data)
+
+    return "main_menu"
 
 
 def update_transaction(user_id):
     """
     Give the user the option to add or update a transaction.
+    Returns the next state of the session.
     """
 
     # Title
@@ -516,17 +563,19 @@ def update_transaction(user_id):
     print("\nAdd or Update Transaction\n")
     print(75 * "-")
 
-    user_wks = SHEET.worksheet(user_id)
+    user_wks = open_worksheet(user_id)
 
     # function to allow the user to select a month and validate
     selection = select_month()
 
     # return the selection and analyse what was inputed
     if selection == "0":
-        return
+        return "main_menu"
     col_num = (int(selection) * 2) + 2
-    data = input_new_transaction(user_wks, col_num)
-    save_data(user_wks, data, col_num)
+    saved_data = user_wks.fresh_col_values(col_num)[1:]
+    data = input_new_transaction(user_wks, list(saved_data), col_num)
+    if save_data(user_wks, data, col_num, saved_data):
+        check_alerts(user_id, user_wks, saved_data, data, col_num)
 
     # Option for the user to update transaction on a new month
     while True:
@@ -535,20 +584,18 @@ def update_transaction(user_id):
             "in a new month? y/n\n")
 
         if option == "n":
-            return
+            return "main_menu"
         elif option == "y":
-            update_transaction(user_id)
-            break
+            return "update_transaction"
         else:
             print("Invalid option! Please enter only Y or N.")
 
 
-def input_new_transaction(user_wks, col_num):
+def input_new_transaction(user_wks, data, col_num):
     """
     Allows the user to update existing data in transactions.
     """
 
-    data = user_wks.col_values(col_num)[1:]
     display_transaction_data(user_wks, data, col_num)
     while True:
         selection = input(
@@ -606,6 +653,7 @@ def view_transaction(user_id):
     """
     Gives the user an option to select a month
     and display all transactions.
+    Returns the next state of the session.
     """
 
     # Title
@@ -613,14 +661,14 @@ def view_transaction(user_id):
     print("\nView Transactions\n")
     print(75 * "-")
 
-    user_wks = SHEET.worksheet(user_id)
+    user_wks = open_worksheet(user_id)
 
     # function to allow the user to select a month and validate
     selection = select_month()
 
     # return the selection and analyse what was inputed
     if selection == "0":
-        return
+        return "main_menu"
     col_num = (int(selection) * 2) + 2
 
     data = user_wks.col_values(col_num)[1:]
@@ -631,10 +679,9 @@ def view_transaction(user_id):
         option = input("\nWould you like to view a new month? y/n\n")
 
         if option == "n":
-            return
+            return "main_menu"
         elif option == "y":
-            view_transaction(user_id)
-            break
+            return "view_transaction"
         else:
             print("Invalid option! Please enter only Y or N.")
 
@@ -642,6 +689,7 @@ def view_transaction(user_id):
 def delete_transactions(user_id):
     """
     This function allows the user to delete transactions.
+    Returns the next state of the session.
     """
 
     # Title
@@ -649,14 +697,14 @@ def delete_transactions(user_id):
     print("\nDelete Transactions\n")
     print(75 * "-")
 
-    user_wks = SHEET.worksheet(user_id)
+    user_wks = open_worksheet(user_id)
 
     # function to allow the user to select a month and validate
     selection = select_month()
 
     # return the selection and analyse what was inputed
     if selection == "0":
-        return
+        return "main_menu"
     col_num = (int(selection) * 2) + 2
     month = user_wks.col_values(col_num - 1)[0]
 
@@ -668,19 +716,508 @@ def delete_transactions(user_id):
         option = input(f"Confirm deletion of {month}'s transactions? y/n\n")
 
         if option == "n":
-            return
+            return "main_menu"
         elif option == "y":
             break
         else:
             print("Invalid option! Please enter only Y or N.")
 
     print(f"Deleting {month}'s transactions...")
-    data = user_wks.col_values(col_num)[1:]
+    saved_data = user_wks.fresh_col_values(col_num)[1:]
+    data = list(saved_data)
 
     for num in range(len(data)):
         data[num] = "0"
 
-    save_data(user_wks, data, col_num)
+    save_data(user_wks, data, col_num, saved_data)
+
+    return "main_menu"
+
+
+def is_transient_error(error):
+    """
+    Checks if an API error is caused by the quota
+    or by the server, so the request can be sent again.
+    """
+
+    status = error.response.status_code
+    return status == 429 or status >= 500
+
+
+def is_missing_worksheet(error):
+    """
+    Checks if an API error is caused by a range
+    of a worksheet that does not exist.
+    """
+
+    return (
+        error.response.status_code == 400
+        and "Unable to parse range" in error.response.text)
+
+
+def retry_wait(error, attempt):
+    """
+    Returns the seconds to wait before sending a request again,
+    from the Retry-After header of the error if the API sent one.
+    """
+
+    retry_after = error.response.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        return int(retry_after) + random.random()
+
+    return min(2 ** attempt, MAX_RETRY_WAIT) + random.random()
+
+
+def with_retries(request, *args, **kwargs):
+    """
+    Sends a request to the API, waiting longer after each
+    transient error before sending it again.
+    """
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            return request(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            if attempt == MAX_RETRIES - 1 or not is_transient_error(e):
+                raise
+            time.sleep(retry_wait(e, attempt))
+
+
+def read_user_worksheets(spreadsheet, user_ids):
+    """
+    Reads the worksheets of the users with a single request.
+    If one of the worksheets is missing, the users are read one by
+    one and None is returned for the missing ones. Any other error
+    is raised once the retries are used up.
+    """
+
+    ranges = [f"'{user_id}'!A1:Z11" for user_id in user_ids]
+    params = {"valueRenderOption": "UNFORMATTED_VALUE"}
+
+    try:
+        response = with_retries(
+            spreadsheet.values_batch_get, ranges, params=params)
+        return [
+            value_range.get("values", [])
+            for value_range in response["valueRanges"]
+        ]
+    except gspread.exceptions.APIError as e:
+        if not is_missing_worksheet(e):
+            raise
+
+    users_values = []
+    for user_range in ranges:
+        try:
+            response = with_retries(
+                spreadsheet.values_get, user_range, params=params)
+            users_values.append(response.get("values", []))
+        except gspread.exceptions.APIError as e:
+            if not is_missing_worksheet(e):
+                raise
+            users_values.append(None)
+
+    return users_values
+
+
+def get_shared_worksheet(title, header):
+    """
+    Returns a worksheet shared by all users,
+    creating it with the header if it does not exist yet.
+    """
+
+    try:
+        return open_worksheet(title)
+    except gspread.exceptions.WorksheetNotFound:
+        shared_wks = SHEET.add_worksheet(
+            title=title, rows=100, cols=len(header))
+        shared_wks.append_row(header)
+        return CachedWorksheet(SHEET, shared_wks._properties)
+
+
+def user_rows(shared_wks, user_id):
+    """
+    Returns the rows of the user in a shared worksheet with their
+    sheet row, reading only the user_id column and the user's rows
+    instead of the rows of every user.
+    """
+
+    # Read directly, as other nodes and the nightly job add rows
+    user_ids = shared_wks.fresh_col_values(1)
+    row_nums = [
+        row_num for row_num, value in enumerate(user_ids, 1)
+        if value == user_id
+    ]
+    if not row_nums:
+        return []
+
+    rows = shared_wks.batch_get(
+        [f"{row_num}:{row_num}" for row_num in row_nums])
+    return [
+        (row_num, row[0] if row else [])
+        for row_num, row in zip(row_nums, rows)
+    ]
+
+
+def previous_month(today):
+    """
+    Returns the month before today as a YYYY-MM string.
+    """
+
+    if today.month == 1:
+        return f"{today.year - 1}-12"
+    return f"{today.year}-{today.month - 1:02d}"
+
+
+def rule_menu(
+        user_id, state, rules_wks, rule_name, value_title, value_prompt,
+        new_rule, on_change=None):
+    """
+    Displays the rules of the user from a shared worksheet and allows
+    the user to add or remove one. new_rule returns the row of a new
+    rule from the selected category and value, and on_change is called
+    after a rule is added or removed.
+    Returns the next state of the session.
+    """
+
+    # Title
+    print(75 * "-")
+    print(f"\n{rule_name.title()}s\n")
+    print(75 * "-")
+
+    user_wks = open_worksheet(user_id)
+    budget_categories = user_wks.col_values(1)[1:]
+
+    # Keep the sheet row of each rule so it can be removed
+    rules = user_rows(rules_wks, user_id)
+
+    title1 = "Categories"
+    print(f"\n{'':4} {title1:25} {value_title}\n")
+    for ind, (row_num, row) in enumerate(rules, 1):
+        category = budget_categories[int(row[1]) - 1]
+        print(f"{ind:<4} {category:25} {row[2]}")
+
+    print(
+        f"\n1. Add a {rule_name}\n"
+        f"2. Remove a {rule_name}\n"
+        "0. Return to main menu")
+
+    option = input("\nYour selection: \n")
+
+    if option == "1":
+        for ind, category in enumerate(budget_categories, 1):
+            print(f"{ind}. {category}")
+        while True:
+            selection = input("\nPlease select a category:\n")
+            if selection != "0" and validate_list_selection(selection, 10):
+                break
+        while True:
+            value = input(f"\nPlease enter {value_prompt}:\n")
+
+            if value.replace(".", "", 1).isdigit():
+                value = float(value)
+                break
+            print("Please enter a valid number.")
+
+        rules_wks.append_row(new_rule(selection, value))
+        print(f"\n{rule_name.capitalize()} saved!")
+    elif option == "2" and not rules:
+        print(f"\nYou have no {rule_name}s to remove.")
+    elif option == "2":
+        while True:
+            selection = input(f"\nPlease select a {rule_name} to remove:\n")
+            if (selection != "0"
+                    and validate_list_selection(selection, len(rules))):
+                break
+        row_num = rules[int(selection) - 1][0]
+
+        # Clear instead of deleting the row so the rows of other rules
+        # do not shift while the nightly job is running
+        rules_wks.batch_clear([f"{row_num}:{row_num}"])
+        print(f"\n{rule_name.capitalize()} removed!")
+    elif option == "0":
+        return "main_menu"
+    else:
+        print("Invalid option")
+
+    if option in ("1", "2") and on_change is not None:
+        on_change(user_id)
+
+    return state
+
+
+def recurring_transactions(user_id):
+    """
+    Allows the user to add or remove recurring transactions,
+    which are added to the monthly transactions by the nightly
+    materialize_recurring.py job.
+    Returns the next state of the session.
+    """
+
+    recurring_wks = get_shared_worksheet("recurring", RECURRING_HEADER)
+
+    # The rule is first posted to this month's transactions
+    last_posted = previous_month(date.today())
+
+    return rule_menu(
+        user_id, "recurring_transactions", recurring_wks,
+        "recurring transaction", "Amount", "the monthly amount",
+        lambda selection, value: [user_id, selection, value, last_posted])
+
+
+def compile_alert_rules(rows):
+    """
+    Groups the alert rules by user_id and then by the sheet row
+    of the category, with the thresholds of each category sorted
+    so they can be checked with a binary search.
+    """
+
+    rules = {}
+
+    # Skip the cleared rows of removed rules
+    for row in rows:
+        if len(row) < 3 or not row[0]:
+            continue
+        user_rules = rules.setdefault(row[0], {})
+        user_rules.setdefault(int(row[1]) + 1, []).append(float(row[2]))
+
+    for user_rules in rules.values():
+        for thresholds in user_rules.values():
+            thresholds.sort()
+
+    return rules
+
+
+def load_alert_rules(user_id):
+    """
+    Reads and compiles the alert rules of the user.
+    """
+
+    alerts_wks = get_shared_worksheet("alerts", ALERTS_HEADER)
+    rows = [row for _, row in user_rows(alerts_wks, user_id)]
+    ALERT_RULES[user_id] = compile_alert_rules(rows).get(user_id, {})
+
+
+def crossed_threshold(thresholds, budget, old_value, new_value):
+    """
+    Returns the highest threshold crossed when a category's
+    transactions change from the old to the new value,
+    or None if no threshold was crossed.
+    """
+
+    if budget <= 0:
+        return None
+
+    # Thresholds are a percentage of the budget
+    old_ind = bisect_right(thresholds, old_value / budget * 100)
+    new_ind = bisect_right(thresholds, new_value / budget * 100)
+    if new_ind > old_ind:
+        return thresholds[new_ind - 1]
+
+    return None
+
+
+def alert_message(month, category, percent, new_value, budget):
+    """
+    Returns the message displayed when an alert is triggered.
+    """
+
+    return (
+        f"{month}: {category} reached {percent:g}% of its budget "
+        f"({new_value} of {budget})")
+
+
+def check_alerts(user_id, user_wks, saved_data, data, col_num):
+    """
+    Checks the alert rules of the categories changed by a save
+    and queues the triggered alerts for the next login.
+    """
+
+    user_rules = ALERT_RULES.get(user_id, {})
+    changed = [
+        ind for ind in range(len(data))
+        if data[ind] != saved_data[ind] and ind + 2 in user_rules
+    ]
+    if not changed:
+        return
+
+    saved_budget = user_wks.col_values(col_num - 1)
+    budget_categories = user_wks.col_values(1)
+
+    messages = []
+    for ind in changed:
+        row = ind + 2
+        budget = float(saved_budget[row - 1])
+        new_value = float(data[ind])
+        percent = crossed_threshold(
+            user_rules[row], budget, float(saved_data[ind]), new_value)
+        if percent is not None:
+            messages.append([user_id, alert_message(
+                saved_budget[0], budget_categories[row - 1],
+                percent, new_value, budget)])
+
+    if messages:
+        queue_wks = get_shared_worksheet("alert_queue", ALERT_QUEUE_HEADER)
+
+        # Insert rows, so the new alerts never overwrite the rows
+        # below a gap in the queue
+        queue_wks.append_rows(messages, insert_data_option="INSERT_ROWS")
+
+
+def show_alerts(user_id):
+    """
+    Displays the alerts queued for the user and removes them.
+    """
+
+    queue_wks = get_shared_worksheet("alert_queue", ALERT_QUEUE_HEADER)
+    rows = user_rows(queue_wks, user_id)
+    if not rows:
+        return
+
+    print("Budget alerts:\n")
+    for row_num, row in rows:
+        print(f"- {row[1]}")
+    print()
+
+    # Delete the rows from the bottom up, so the row numbers still to
+    # delete don't shift, and the queue shrinks instead of leaving gaps
+    SHEET.batch_update({"requests": [
+        {"deleteDimension": {"range": {
+            "sheetId": queue_wks.id,
+            "dimension": "ROWS",
+            "startIndex": row_num - 1,
+            "endIndex": row_num,
+        }}}
+        for row_num, _ in sorted(rows, reverse=True)
+    ]})
+    invalidate(queue_wks.title)
+
+
+def budget_alerts(user_id):
+    """
+    Allows the user to add or remove budget alerts, which are
+    triggered when a category's transactions reach a percentage
+    of its budget.
+    Returns the next state of the session.
+    """
+
+    alerts_wks = get_shared_worksheet("alerts", ALERTS_HEADER)
+
+    return rule_menu(
+        user_id, "budget_alerts", alerts_wks,
+        "budget alert", "Percent (%)", "the percent of the budget",
+        lambda selection, value: [user_id, selection, value],
+        on_change=load_alert_rules)
+
+
+def main_menu(user_id):
+    """
+    Displays the main menu and returns the state
+    selected by the user.
+    """
+
+    print(75 * "-")
+    print("\nPlease select one of the options bellow:\n")
+    print(
+        "\n1. New budget\n"
+        "2. View budget\n"
+        "3. Update budget\n"
+        "4. Delete budget\n"
+        "5. Add or update transaction\n"
+        "6. View transactions\n"
+        "7. Delete transactions\n"
+        "8. Recurring transactions\n"
+        "9. Budget alerts\n"
+        "10. Log out\n")
+
+    option = input("Your selections: \n")
+
+    if option in MENU_OPTIONS:
+        return MENU_OPTIONS[option]
+
+    print("Invalid option")
+    return "main_menu"
+
+
+# Main menu options and the state each one leads to
+MENU_OPTIONS = {
+    "1": "new_budget",
+    "2": "view_budget",
+    "3": "update_budget",
+    "4": "delete_budget",
+    "5": "update_transaction",
+    "6": "view_transaction",
+    "7": "delete_transactions",
+    "8": "recurring_transactions",
+    "9": "budget_alerts",
+    "10": "log_out",
+}
+
+# Every state of a session and the function that runs it.
+# Each function returns the name of the next state.
+SESSION_STATES = {
+    "main_menu": main_menu,
+    "new_budget": new_budget,
+    "view_budget": view_budget,
+    "update_budget": update_budget,
+    "delete_budget": delete_budget,
+    "update_transaction": update_transaction,
+    "view_transaction": view_transaction,
+    "delete_transactions": delete_transactions,
+    "recurring_transactions": recurring_transactions,
+    "budget_alerts": budget_alerts,
+}
+
+
+def session_path(user_id):
+    """
+    Returns the path of the file where the user's session is parked.
+    """
+
+    return os.path.join(SESSIONS_DIR, f"{user_id}.json")
+
+
+def park_session(session):
+    """
+    Saves the session state to disk so it can be resumed later.
+    """
+
+    os.makedirs(SESSIONS_DIR, exist_ok=True)
+    with open(session_path(session["user_id"]), "w") as session_file:
+        json.dump(session, session_file)
+
+
+def resume_session(name, user_id):
+    """
+    Loads the user's parked session if there is one,
+    or starts a new session at the main menu.
+    """
+
+    try:
+        with open(session_path(user_id)) as session_file:
+            session = json.load(session_file)
+    except (OSError, ValueError):
+        session = {}
+
+    if session.get("state") in SESSION_STATES:
+        print("Resuming your previous session...\n")
+    else:
+        session = {"state": "main_menu"}
+
+    session["name"] = name
+    session["user_id"] = user_id
+
+    return session
+
+
+def end_session(session):
+    """
+    Removes the user's parked session on log out.
+    """
+
+    try:
+        os.remove(session_path(session["user_id"]))
+    except OSError:
+        pass
 
 
 def main():
@@ -694,43 +1231,23 @@ def main():
     print(75 * "-")
     print(f"\nWelcome {name.title()}!\n")
 
-    while True:
+    show_alerts(user_id)
+    load_alert_rules(user_id)
 
-        print(75 * "-")
-        print("\nPlease select one of the options bellow:\n")
-        print(
-            "\n1. New budget\n"
-            "2. View budget\n"
-            "3. Update budget\n"
-            "4. Delete budget\n"
-            "5. Add or update transaction\n"
-            "6. View transactions\n"
-            "7. Delete transactions\n"
-            "8. Log out\n")
-
-        option = input("Your selections: \n")
-
-        if option == "1":
-            new_budget(user_id)
-        elif option == "2":
-            view_budget(user_id)
-        elif option == "3":
-            update_budget(user_id)
-        elif option == "4":
-            delete_budget(user_id)
-        elif option == "5":
-            update_transaction(user_id)
-        elif option == "6":
-            view_transaction(user_id)
-        elif option == "7":
-            delete_transactions(user_id)
-        elif option == "8":
-            print(
-                "\nThank you for using Finance Guardian.\n"
-                f"Good bye {name}!\n")
-            quit()
-        else:
-            print("Invalid option")
+    session = resume_session(name, user_id)
+
+    # Run one state at a time, so the call stack does not grow
+    # however long the session is.
+    while session["state"] != "log_out":
+        park_session(session)
+        state = SESSION_STATES[session["state"]]
+        session["state"] = state(user_id)
+
+    end_session(session)
+    print(
+        "\nThank you for using Finance Guardian.\n"
+        f"Good bye {name}!\n")
 
 
-main()
+if __name__ == "__main__":
+    main()
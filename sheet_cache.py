@@ -0,0 +1,190 @@
+"""
+Read-through cache of Google Sheets reads, shared on disk
+by all the sessions running on the same node.
+"""
+import json
+import os
+import sqlite3
+import time
+
+import gspread
+
+CACHE_PATH = "sheet_cache.db"
+
+# Seconds before a cached read is fetched again from the API,
+# so writes made on other nodes are picked up
+CACHE_TTL = 300
+
+# Size in bytes above which the least recently used reads are evicted
+MAX_CACHE_SIZE = 20 * 1024 * 1024
+
+# Connection of this process to the cache database, and the process
+# that opened it, as a connection must not be used after a fork
+CONNECTION = None
+CONNECTION_PID = None
+
+
+def get_connection():
+    """
+    Opens the cache database the first time it is used
+    in this process.
+    """
+
+    global CONNECTION, CONNECTION_PID
+    if CONNECTION is None or CONNECTION_PID != os.getpid():
+        CONNECTION_PID = os.getpid()
+        CONNECTION = sqlite3.connect(
+            CACHE_PATH, timeout=10, isolation_level=None)
+        CONNECTION.execute("PRAGMA journal_mode=WAL")
+        CONNECTION.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "worksheet TEXT, cell_range TEXT, version INTEGER, "
+            "value TEXT, size INTEGER, expires REAL, last_used REAL, "
+            "PRIMARY KEY (worksheet, cell_range))")
+        CONNECTION.execute(
+            "CREATE TABLE IF NOT EXISTS versions ("
+            "worksheet TEXT PRIMARY KEY, version INTEGER)")
+    return CONNECTION
+
+
+def close_connection():
+    """
+    Closes the connection of this process, which must be done
+    before forking so the child processes don't inherit it.
+    """
+
+    global CONNECTION
+    if CONNECTION is not None and CONNECTION_PID == os.getpid():
+        CONNECTION.close()
+    CONNECTION = None
+
+
+def get_version(connection, worksheet):
+    """
+    Returns the version of the worksheet, which changes
+    every time this node writes to it.
+    """
+
+    row = connection.execute(
+        "SELECT version FROM versions WHERE worksheet = ?",
+        (worksheet,)).fetchone()
+    return row[0] if row else 0
+
+
+def cached_read(worksheet, cell_range, load, refresh=False):
+    """
+    Returns the cached value of a range of the worksheet,
+    or calls load to read it from the API and caches it.
+    With refresh, the range is always read from the API.
+    """
+
+    connection = get_connection()
+    now = time.time()
+    version = get_version(connection, worksheet)
+
+    row = None
+    if not refresh:
+        row = connection.execute(
+            "SELECT value, version, expires FROM entries "
+            "WHERE worksheet = ? AND cell_range = ?",
+            (worksheet, cell_range)).fetchone()
+    if row and row[1] == version and row[2] > now:
+        connection.execute(
+            "UPDATE entries SET last_used = ? "
+            "WHERE worksheet = ? AND cell_range = ?",
+            (now, worksheet, cell_range))
+        return json.loads(row[0])
+
+    # The version is read before loading, so a value loaded while
+    # another session writes is not served after the write
+    value = load()
+    data = json.dumps(value)
+    connection.execute(
+        "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (worksheet, cell_range, version, data, len(data),
+         now + CACHE_TTL, now))
+    evict(connection)
+
+    return value
+
+
+def evict(connection):
+    """
+    Removes the least recently used reads while the cache
+    is bigger than its maximum size.
+    """
+
+    total = connection.execute(
+        "SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+    if total <= MAX_CACHE_SIZE:
+        return
+
+    rows = connection.execute(
+        "SELECT worksheet, cell_range, size FROM entries "
+        "ORDER BY last_used").fetchall()
+    for worksheet, cell_range, size in rows:
+        connection.execute(
+            "DELETE FROM entries WHERE worksheet = ? AND cell_range = ?",
+            (worksheet, cell_range))
+        total -= size
+        if total <= MAX_CACHE_SIZE:
+            break
+
+
+def invalidate(worksheet):
+    """
+    Changes the version of the worksheet after this node writes
+    to it, so its cached reads are fetched again.
+    """
+
+    connection = get_connection()
+    connection.execute(
+        "INSERT INTO versions VALUES (?, 1) ON CONFLICT (worksheet) "
+        "DO UPDATE SET version = version + 1", (worksheet,))
+    connection.execute(
+        "DELETE FROM entries WHERE worksheet = ?", (worksheet,))
+
+
+class CachedWorksheet(gspread.Worksheet):
+    """
+    Worksheet whose column reads go through the cache
+    and whose writes invalidate it.
+    """
+
+    def col_values(self, col, value_render_option="FORMATTED_VALUE"):
+        return cached_read(
+            self.title, f"col{col}:{value_render_option}",
+            lambda: super(CachedWorksheet, self).col_values(
+                col, value_render_option))
+
+    def fresh_col_values(self, col):
+        """
+        Reads the column from the API and refreshes the cache.
+        Used before writing, as the cache of this node does not see
+        the writes of other nodes, like the recurring transactions job.
+        """
+
+        return cached_read(
+            self.title, f"col{col}:FORMATTED_VALUE",
+            lambda: super(CachedWorksheet, self).col_values(col),
+            refresh=True)
+
+    def update_cell(self, row, col, value):
+        response = super().update_cell(row, col, value)
+        invalidate(self.title)
+        return response
+
+    def append_row(self, values, **kwargs):
+        response = super().append_row(values, **kwargs)
+        invalidate(self.title)
+        return response
+
+    def append_rows(self, values, **kwargs):
+        response = super().append_rows(values, **kwargs)
+        invalidate(self.title)
+        return response
+
+    def batch_clear(self, ranges):
+        response = super().batch_clear(ranges)
+        invalidate(self.title)
+        return response
@@ -0,0 +1,238 @@
+"""
+Offline job that compares the spending of all users.
+
+It loads the monthly transactions of every user into a
+users x months x categories matrix, computes the cohort average,
+the month over month trend and an anomaly score for each user,
+and writes a summary to the "analytics" worksheet.
+
+Run it with:
+    python3 spending_analytics.py
+"""
+import tempfile
+
+import gspread
+import numpy as np
+
+from run import SHEET, read_user_worksheets, with_retries
+
+# Number of user worksheets read with a single request
+READ_CHUNK_SIZE = 100
+
+# Number of users scored at once, to bound the memory used
+SCORE_CHUNK_SIZE = 10000
+
+# Number of users listed in the anomalies table
+TOP_ANOMALIES = 20
+
+MONTHS = 12
+CATEGORIES = 10
+
+
+def load_user_ids():
+    """
+    Returns the ids of all users from the data worksheet.
+    """
+
+    id_data = SHEET.worksheet("data").col_values(1)
+    return [user_id for user_id in id_data if user_id.isdigit()]
+
+
+def to_matrix(values):
+    """
+    Converts the values read from a user worksheet into a
+    months x categories array of the transaction amounts.
+    """
+
+    matrix = np.zeros((MONTHS, CATEGORIES), dtype=np.float32)
+
+    # Category rows start on row 2 and the transactions of
+    # each month are on columns D, F, H...
+    for category, row in enumerate(values[1:CATEGORIES + 1]):
+        for month in range(MONTHS):
+            col = (month * 2) + 3
+            if col < len(row) and row[col] != "":
+                matrix[month, category] = float(row[col])
+
+    return matrix
+
+
+def read_chunk(user_ids):
+    """
+    Reads the worksheets of a chunk of users and converts them into
+    matrices. Users whose worksheet is missing are left out, and any
+    other error stops the job, so the summary is never built from
+    missing data.
+    Returns the user_ids read and their matrices.
+    """
+
+    read_ids = []
+    matrices = []
+    users_values = read_user_worksheets(SHEET, user_ids)
+    for user_id, values in zip(user_ids, users_values):
+        if values is None:
+            print(f"Skipped user {user_id} without a worksheet")
+            continue
+        read_ids.append(user_id)
+        matrices.append(to_matrix(values))
+
+    return read_ids, matrices
+
+
+def load_spending(user_ids, path):
+    """
+    Loads the transactions of all users into a users x months x
+    categories matrix kept on disk, and adds up the sums needed
+    for the cohort statistics while reading.
+    Returns the matrix of the users read and their user_ids.
+    """
+
+    spending = np.memmap(
+        path, dtype=np.float32, mode="w+",
+        shape=(len(user_ids), MONTHS, CATEGORIES))
+    totals = np.zeros((MONTHS, CATEGORIES))
+    squares = np.zeros((MONTHS, CATEGORIES))
+    counts = np.zeros(MONTHS)
+    loaded_ids = []
+
+    for start in range(0, len(user_ids), READ_CHUNK_SIZE):
+        chunk_ids, matrices = read_chunk(
+            user_ids[start:start + READ_CHUNK_SIZE])
+        if not matrices:
+            continue
+        chunk = np.stack(matrices)
+        spending[len(loaded_ids):len(loaded_ids) + len(chunk)] = chunk
+        loaded_ids += chunk_ids
+
+        # Only months with transactions count towards the cohort
+        active = chunk.sum(axis=2) > 0
+        masked = chunk * active[:, :, np.newaxis]
+        totals += masked.sum(axis=0)
+        squares += (masked.astype(np.float64) ** 2).sum(axis=0)
+        counts += active.sum(axis=0)
+
+        print(f"Loaded {len(loaded_ids)} of {len(user_ids)} users")
+
+    spending.flush()
+    return spending[:len(loaded_ids)], loaded_ids, totals, squares, counts
+
+
+def cohort_statistics(totals, squares, counts):
+    """
+    Returns the cohort average and standard deviation of each month
+    and category, and the month over month trend of the average.
+    """
+
+    users = np.maximum(counts, 1)[:, np.newaxis]
+    average = totals / users
+    std = np.sqrt(np.maximum(squares / users - average ** 2, 0))
+
+    trend = np.zeros_like(average)
+    previous = average[:-1]
+    np.divide(
+        average[1:] - previous, previous,
+        out=trend[1:], where=previous > 0)
+
+    return average, std, trend
+
+
+def anomaly_scores(spending, average, std):
+    """
+    Scores each user with the largest z-score of their spending
+    against the cohort, and returns the scores with the month and
+    category where it happened.
+    """
+
+    users = len(spending)
+    scores = np.zeros(users, dtype=np.float32)
+    cells = np.zeros(users, dtype=np.int64)
+    safe_std = np.where(std > 0, std, 1)
+
+    for start in range(0, users, SCORE_CHUNK_SIZE):
+        chunk = np.asarray(spending[start:start + SCORE_CHUNK_SIZE])
+        active = chunk.sum(axis=2, keepdims=True) > 0
+        z_scores = np.abs(chunk - average) / safe_std
+        z_scores = np.where(active & (std > 0), z_scores, 0)
+
+        flat = z_scores.reshape(len(chunk), -1)
+        cells[start:start + len(chunk)] = flat.argmax(axis=1)
+        scores[start:start + len(chunk)] = flat.max(axis=1)
+
+    return scores, cells
+
+
+def write_summary(
+        months, categories, counts, average, std, trend,
+        user_ids, scores, cells):
+    """
+    Writes the cohort table and the most anomalous users
+    to the analytics worksheet with a single request.
+    """
+
+    cohort = [["Month", "Category", "Users", "Average", "Std", "Trend"]]
+    for month in range(MONTHS):
+        for category in range(CATEGORIES):
+            cohort.append([
+                months[month], categories[category], int(counts[month]),
+                round(float(average[month, category]), 2),
+                round(float(std[month, category]), 2),
+                round(float(trend[month, category]), 4),
+            ])
+
+    anomalies = [["User id", "Score", "Month", "Category"]]
+    top = min(TOP_ANOMALIES, len(scores))
+    top_users = np.argpartition(-scores, top - 1)[:top] if top else []
+    for user in sorted(top_users, key=lambda user: -scores[user]):
+        month, category = divmod(int(cells[user]), CATEGORIES)
+        anomalies.append([
+            user_ids[user], round(float(scores[user]), 2),
+            months[month], categories[category],
+        ])
+
+    try:
+        analytics_wks = SHEET.worksheet("analytics")
+        analytics_wks.clear()
+    except gspread.exceptions.WorksheetNotFound:
+        SHEET.add_worksheet(
+            title="analytics", rows=len(cohort) + 1, cols=11)
+
+    with_retries(SHEET.values_batch_update, {
+        "valueInputOption": "RAW",
+        "data": [
+            {"range": "analytics!A1", "values": cohort},
+            {"range": "analytics!H1", "values": anomalies},
+        ],
+    })
+
+
+def main():
+    """
+    Run the spending analytics job.
+    """
+
+    # Month and category names from the blank template
+    blank_worksheet = SHEET.worksheet("blank")
+    categories = blank_worksheet.col_values(1)[1:CATEGORIES + 1]
+    months = blank_worksheet.row_values(1)[2::2][:MONTHS]
+
+    user_ids = load_user_ids()
+    print(f"Analysing the spending of {len(user_ids)} users...")
+    if not user_ids:
+        return
+
+    with tempfile.NamedTemporaryFile(suffix=".dat") as matrix_file:
+        spending, user_ids, totals, squares, counts = load_spending(
+            user_ids, matrix_file.name)
+        average, std, trend = cohort_statistics(totals, squares, counts)
+        scores, cells = anomaly_scores(spending, average, std)
+        del spending
+
+    write_summary(
+        months, categories, counts, average, std, trend,
+        user_ids, scores, cells)
+
+    print("Spending analytics saved.")
+
+
+if __name__ == "__main__":
+    main()